@@ -1,39 +1,225 @@
 import os
+
+# Socket.IO async mode: 'threading' (default, used on Railway), 'gevent'
+# or 'eventlet'; the greenlet modes must monkey patch before anything else
+# is imported
+ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+elif ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+
 from flask import Flask, render_template, request, jsonify, send_from_directory
-from flask_socketio import SocketIO, emit, join_room, leave_room, close_room
+from flask.json.provider import JSONProvider
+from werkzeug.middleware.shared_data import SharedDataMiddleware
+from flask_socketio import SocketIO, emit, join_room, leave_room
 import random
 import time
 from datetime import datetime
 import logging
-import uuid
-from threading import Timer
+import secrets
+import heapq
+import functools
+import itertools
+import threading
+import orjson
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson (always compact UTF-8)"""
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+            mimetype=self.mimetype
+        )
+
+class OrjsonPackets:
+    """json module stand-in for Socket.IO/Engine.IO packet encoding"""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        # Callers pass compact separators, which orjson always uses
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
+# Static assets keep their file names across deploys, so cache them for a
+# day and let ETag/Last-Modified revalidation handle updates
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 86400
+# Behind a front end that honours X-Sendfile, hand /img, /music and /fonts
+# off to it instead of streaming the bytes through the WSGI worker
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', 'False').lower() == 'true'
+
+# Verbose Socket.IO/Engine.IO packet logging, for local debugging only
+DEBUG = os.environ.get('DEBUG', 'False').lower() == 'true'
+
+# Socket.IO wire format: 'default' (JSON) works with the bundled web client,
+# 'msgpack' needs clients using socket.io-msgpack-parser
+SOCKETIO_SERIALIZER = os.environ.get('SOCKETIO_SERIALIZER', 'default')
 
-# Configure for Railway (NO eventlet, use threading)
 socketio = SocketIO(
-    app, 
+    app,
     cors_allowed_origins="*",
-    async_mode='threading',
+    async_mode=ASYNC_MODE,
+    serializer=SOCKETIO_SERIALIZER,
+    json=OrjsonPackets,
+    # Handlers never touch flask.session, so skip the per-connection copy
+    manage_session=False,
     ping_timeout=60,
     ping_interval=25,
-    logger=False,
-    engineio_logger=False
+    # Long-polling responses above 512 bytes (room rosters, game_started)
+    # are gzip/deflate compressed; websocket frames already get
+    # permessage-deflate from simple-websocket
+    http_compression=True,
+    compression_threshold=512,
+    logger=DEBUG,
+    engineio_logger=DEBUG
 )
 
 # Game state management
 rooms = {}
-players = {}
+players = {}  # sid -> id of the room that player is in
 user_sessions = {}
-phase_timers = {}  # Store timers for auto-phase transitions
+phase_timers = {}  # Current phase-transition token per room
+# Min-heap of (expires_at, room_id), pushed whenever a room is left empty;
+# entries for rooms that filled up again are skipped when popped
+_expiry_heap = []
+_expiry_lock = threading.Lock()
+# Serialized GET /api/rooms body; dropped whenever a room or its player
+# count changes
+_lobby_cache = {'body': None, 'expires': 0.0, 'generation': 0}
+_lobby_lock = threading.Lock()
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+# WARNING in production unless LOG_LEVEL says otherwise; DEBUG=true logs all
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG' if DEBUG else 'WARNING').upper()
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
 NIGHT_DURATION = 30  # seconds
 DAY_DURATION = 45    # seconds
+ROOM_IDLE_TTL = 300  # seconds an empty room is kept around
+LOBBY_CACHE_TTL = 1.0   # seconds a serialized room list may be reused
+CHAT_FLUSH_DELAY = 0.05  # seconds chat messages are buffered per room
+CHAT_BATCH_MAX = 64      # buffered messages that force an early flush
+MAX_CHAT_LEN = 500       # characters kept from a chat message
+CHAT_MIN_INTERVAL = 0.2  # seconds between chat messages from one socket
+
+# Role descriptions in Arabic, with the icon and color the client shows
+ROLE_META = {
+    'mafia': {'role_ar': 'مافيا', 'icon': '🔫', 'color': '#dc2626'},
+    'detective': {'role_ar': 'محقق', 'icon': '🔍', 'color': '#2563eb'},
+    'doctor': {'role_ar': 'طبيب', 'icon': '🏥', 'color': '#16a34a'},
+    'villager': {'role_ar': 'مواطن', 'icon': '👥', 'color': '#6b7280'}
+}
+# Complete role_assigned payloads, shared by every emit (never mutated)
+ROLE_PAYLOADS = {role: {'role': role, **meta} for role, meta in ROLE_META.items()}
+
+# Phase announcements
+NIGHT_MSG = 'الليل {} - المافيا تختار ضحيتها'
+DAY_KILLED_MSG = '☀️ الصباح - {} تم قتله الليلة!'
+DAY_SAVED_MSG = '☀️ الصباح - الطبيب أنقذ {}!'
+DAY_QUIET_MSG = '☀️ الصباح - ليلة هادئة، لم يمت أحد'
+WIN_MESSAGES = {
+    'mafia': '🔫 المافيا فازت!',
+    'villagers': '🎉 القرية فازت!'
+}
+
+# Delayed callbacks for all rooms share one background task driven by a
+# min-heap of (deadline, seq, callback, args)
+_schedule_heap = []
+_schedule_cond = threading.Condition()
+_schedule_seq = itertools.count()
+_scheduler_started = False
+
+def schedule(delay, callback, *args):
+    """Run callback(*args) after delay seconds on the shared scheduler"""
+    global _scheduler_started
+    with _schedule_cond:
+        heapq.heappush(_schedule_heap, (time.monotonic() + delay, next(_schedule_seq), callback, args))
+        if not _scheduler_started:
+            _scheduler_started = True
+            socketio.start_background_task(_run_scheduler)
+        _schedule_cond.notify()
+
+def _run_scheduler():
+    while True:
+        with _schedule_cond:
+            while not _schedule_heap or _schedule_heap[0][0] > time.monotonic():
+                timeout = _schedule_heap[0][0] - time.monotonic() if _schedule_heap else None
+                _schedule_cond.wait(timeout)
+            _, _, callback, args = heapq.heappop(_schedule_heap)
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.error("Scheduled callback error: %s", e)
+
+def public_player(player):
+    """Project a player entry to the fields every client needs (no role).
+
+    sid stays in: clients use it as the target id for night actions
+    (target_sid), day votes (vote_for_sid) and voice peers.
+    """
+    return {
+        'sid': player['sid'],
+        'nickname': player['nickname'],
+        'alive': player['alive']
+    }
+
+def revealed_player(player):
+    """Public projection plus the role, for the end-of-game reveal"""
+    return {**public_player(player), 'role': player['role']}
+
+@functools.lru_cache(maxsize=32)
+def role_pool(player_count):
+    """Unshuffled roles for a game of player_count players"""
+    mafia_count = max(1, player_count // 4)
+    detective_count = 1 if player_count >= 6 else 0
+    doctor_count = 1 if player_count >= 5 else 0
+    villager_count = player_count - mafia_count - detective_count - doctor_count
+    return (('mafia',) * mafia_count
+            + ('detective',) * detective_count
+            + ('doctor',) * doctor_count
+            + ('villager',) * villager_count)
+
+# phase_change payloads that depend only on the round number; the cached
+# dicts are shared between rooms and must not be mutated
+@functools.lru_cache(maxsize=64)
+def night_payload(round_number):
+    return {
+        'phase': 'night',
+        'round': round_number,
+        'message': NIGHT_MSG.format(round_number)
+    }
+
+@functools.lru_cache(maxsize=64)
+def quiet_day_payload(round_number):
+    return {
+        'phase': 'day',
+        'round': round_number,
+        'message': DAY_QUIET_MSG,
+        'killed': None
+    }
+
+def player_nickname(room, sid):
+    """Nickname of sid in room, or 'Unknown' if they are not (or no longer) in it"""
+    player = room.players.get(sid)
+    return player['nickname'] if player else 'Unknown'
 
 class GameRoom:
     def __init__(self, room_id, name, max_players, host_id):
@@ -42,6 +228,10 @@ class GameRoom:
         self.max_players = max_players
         self.host_id = host_id
         self.players = {}
+        # Socket.IO room holding the alive mafia, for their private chat
+        self.mafia_room = f"{room_id}:mafia"
+        # Serializes socket handlers and phase transitions touching this room
+        self.lock = threading.RLock()
         self.game_state = {
             'phase': 'waiting',
             'round': 0,
@@ -54,113 +244,122 @@ class GameRoom:
             'investigated_tonight': None
         }
         self.roles_assigned = False
+        # Alive bookkeeping, maintained on death/leave so the win check is O(1)
+        # sid -> role each alive player was counted under at assignment
+        self.alive_roles = {}
+        self.alive_mafia = 0
+        self.alive_villagers = 0
+        # (event, Socket.IO room) -> chat messages waiting for the next flush
+        self.pending_chat = {}
         self.created_at = datetime.now()
-        self.last_activity = datetime.now()
+        # Monotonic, only ever compared against other monotonic readings
+        self.last_activity = time.monotonic()
 
     def update_activity(self):
-        self.last_activity = datetime.now()
+        self.last_activity = time.monotonic()
 
     def is_empty(self):
         return len(self.players) == 0
 
+    def queue_chat(self, event, target, message):
+        """Buffer a chat message; the batch goes out as one event to target"""
+        with self.lock:
+            key = (event, target)
+            pending = self.pending_chat.get(key)
+            if pending is None:
+                pending = self.pending_chat[key] = []
+                schedule(CHAT_FLUSH_DELAY, self.flush_chat, key)
+            pending.append(message)
+            if len(pending) >= CHAT_BATCH_MAX:
+                self.flush_chat(key)
+
+    def flush_chat(self, key):
+        with self.lock:
+            messages = self.pending_chat.pop(key, None)
+            if messages:
+                event, target = key
+                socketio.emit(event, {'messages': messages}, room=target)
+
+    def public_players(self):
+        """Roster for broadcasts: only what other players may see mid-game"""
+        return [public_player(p) for p in self.players.values()]
+
+    def mark_dead(self, sid):
+        """Mark a player dead and update the alive counters"""
+        player = self.players[sid]
+        player['alive'] = False
+        self._drop_alive(sid)
+
+    def remove_player(self, sid):
+        """Remove a player from the room, counting them out if still alive"""
+        player = self.players.pop(sid)
+        self._drop_alive(sid)
+        return player
+
+    def _drop_alive(self, sid):
+        # Decrement by the role that was counted, not the player entry's
+        # current role, so the counters can never drift from each other
+        role = self.alive_roles.pop(sid, None)
+        if role == 'mafia':
+            self.alive_mafia -= 1
+            socketio.server.leave_room(sid, self.mafia_room, namespace='/')
+        elif role is not None:
+            self.alive_villagers -= 1
+
     def assign_roles(self):
         try:
             player_count = len(self.players)
             if player_count < 3:
                 return False
 
-            # Calculate role distribution
-            mafia_count = max(1, player_count // 4)
-            detective_count = 1 if player_count >= 6 else 0
-            doctor_count = 1 if player_count >= 5 else 0
-            villager_count = player_count - mafia_count - detective_count - doctor_count
-
-            # Create role pool
-            roles = ['mafia'] * mafia_count
-            if detective_count:
-                roles.append('detective')
-            if doctor_count:
-                roles.append('doctor')
-            roles.extend(['villager'] * villager_count)
-            
+            # Shuffle a copy of the cached pool for this player count
+            roles = list(role_pool(player_count))
             random.shuffle(roles)
+            mafia_count = roles.count('mafia')
+            socketio.server.close_room(self.mafia_room, namespace='/')
             
             # Assign roles to players
-            for i, (player_id, player) in enumerate(self.players.items()):
-                if i < len(roles):
-                    role = roles[i]
-                    player['role'] = role
-                    player['alive'] = True
-                    
-                    # Role descriptions in Arabic
-                    role_info = {
-                        'role': role,
-                        'role_ar': self.get_role_arabic(role),
-                        'icon': self.get_role_icon(role),
-                        'color': self.get_role_color(role)
-                    }
-                    
-                    # Notify player of their role
-                    socketio.emit('role_assigned', role_info, room=player_id)
-            
+            # roles has exactly one entry per player, in dict insertion order
+            for (player_id, player), role in zip(self.players.items(), roles):
+                player['role'] = role
+                player['alive'] = True
+                if role == 'mafia':
+                    socketio.server.enter_room(player_id, self.mafia_room, namespace='/')
+
+                # Notify player of their role
+                socketio.emit('role_assigned', ROLE_PAYLOADS[role], room=player_id)
+
+            self.alive_roles = {sid: player['role'] for sid, player in self.players.items()}
+            self.alive_mafia = mafia_count
+            self.alive_villagers = player_count - mafia_count
             self.roles_assigned = True
             return True
         except Exception as e:
-            logger.error(f"Error assigning roles: {e}")
+            logger.error("Error assigning roles: %s", e)
             return False
 
-    def get_role_arabic(self, role):
-        roles_ar = {
-            'mafia': 'مافيا',
-            'detective': 'محقق',
-            'doctor': 'طبيب',
-            'villager': 'مواطن'
-        }
-        return roles_ar.get(role, 'مواطن')
-
-    def get_role_icon(self, role):
-        icons = {
-            'mafia': '🔫',
-            'detective': '🔍',
-            'doctor': '🏥',
-            'villager': '👥'
-        }
-        return icons.get(role, '👥')
-
-    def get_role_color(self, role):
-        colors = {
-            'mafia': '#dc2626',
-            'detective': '#2563eb',
-            'doctor': '#16a34a',
-            'villager': '#6b7280'
-        }
-        return colors.get(role, '#6b7280')
-
     def start_night(self):
         try:
             self.game_state['phase'] = 'night'
             self.game_state['round'] += 1
-            self.game_state['mafia_votes'] = {}
-            self.game_state['doctor_votes'] = {}
-            self.game_state['detective_votes'] = {}
+            self.game_state['mafia_votes'].clear()
+            self.game_state['doctor_votes'].clear()
+            self.game_state['detective_votes'].clear()
             self.game_state['killed_tonight'] = None
             self.game_state['saved_tonight'] = None
             self.game_state['investigated_tonight'] = None
             
             # Notify all players
-            socketio.emit('phase_change', {
-                'phase': 'night',
-                'round': self.game_state['round'],
-                'message': f'الليل {self.game_state["round"]} - المافيا تختار ضحيتها'
-            }, room=self.id)
+            socketio.emit('phase_change', night_payload(self.game_state['round']),
+                          room=self.id)
             
-            logger.info(f"Room {self.id}: Night {self.game_state['round']} started")
+            logger.info("Room %s: Night %s started", self.id, self.game_state['round'])
             
             # Schedule auto-transition to day
             self.schedule_phase_transition('day', NIGHT_DURATION)
             return True
         except Exception as e:
-            logger.error(f"Error starting night: {e}")
+            logger.error("Error starting night: %s", e)
             return False
 
     def start_day(self):
@@ -173,91 +372,95 @@ class GameRoom:
             if killed_player and killed_player != saved_player:
                 # Kill the player
                 if killed_player in self.players:
-                    self.players[killed_player]['alive'] = False
+                    self.mark_dead(killed_player)
                     actual_kill = killed_player
-                    logger.info(f"Player {killed_player} was killed")
+                    logger.info("Player %s was killed", killed_player)
             
             # Build message
             if actual_kill:
-                killed_name = self.players[actual_kill]['nickname']
-                message = f"☀️ الصباح - {killed_name} تم قتله الليلة!"
+                message = DAY_KILLED_MSG.format(player_nickname(self, actual_kill))
             elif killed_player and saved_player:
-                saved_name = self.players[saved_player]['nickname']
-                message = f"☀️ الصباح - الطبيب أنقذ {saved_name}!"
+                message = DAY_SAVED_MSG.format(player_nickname(self, saved_player))
             else:
-                message = "☀️ الصباح - ليلة هادئة، لم يمت أحد"
+                message = DAY_QUIET_MSG
             
             # Update game state
             self.game_state['phase'] = 'day'
-            self.game_state['day_votes'] = {}
+            self.game_state['day_votes'].clear()
             self.game_state['killed'] = actual_kill
             
             # Notify all players
-            socketio.emit('phase_change', {
-                'phase': 'day',
-                'round': self.game_state['round'],
-                'message': message,
-                'killed': actual_kill
-            }, room=self.id)
+            if actual_kill is None and not (killed_player and saved_player):
+                payload = quiet_day_payload(self.game_state['round'])
+            else:
+                payload = {
+                    'phase': 'day',
+                    'round': self.game_state['round'],
+                    'message': message,
+                    'killed': actual_kill
+                }
+            socketio.emit('phase_change', payload, room=self.id)
             
-            logger.info(f"Room {self.id}: Day {self.game_state['round']} started - {message}")
+            logger.info("Room %s: Day %s started - %s", self.id, self.game_state['round'], message)
             
             # Schedule auto-transition to night
             self.schedule_phase_transition('night', DAY_DURATION)
             return True
         except Exception as e:
-            logger.error(f"Error starting day: {e}")
+            logger.error("Error starting day: %s", e)
             return False
 
     def schedule_phase_transition(self, next_phase, delay):
         """Schedule automatic phase transition"""
         try:
-            # Cancel existing timer
-            if self.id in phase_timers:
-                phase_timers[self.id].cancel()
-            
+            # Replacing the token invalidates any transition still pending
+            token = object()
+            phase_timers[self.id] = token
+
             def do_transition():
-                try:
-                    room = rooms.get(self.id)
-                    if not room:
+                room = rooms.get(self.id)
+                if not room:
+                    return
+                with room.lock:
+                    if phase_timers.get(self.id) is not token:
                         return
-                    
-                    # Check win condition
-                    winner = room.check_game_end()
-                    if winner:
-                        end_game(room, winner)
+                    if room.is_empty():
+                        # Everyone left mid-game: stop the day/night loop
+                        # instead of broadcasting to nobody, and end the game
+                        # so anyone joining later doesn't land in a frozen phase
+                        phase_timers.pop(self.id, None)
+                        room.game_state['phase'] = 'ended'
                         return
-                    
-                    # Transition to next phase
-                    if next_phase == 'day':
-                        room.start_day()
-                    elif next_phase == 'night':
-                        room.start_night()
-                except Exception as e:
-                    logger.error(f"Error in phase transition: {e}")
-            
-            timer = Timer(delay, do_transition)
-            timer.daemon = True
-            timer.start()
-            phase_timers[self.id] = timer
-            
-            logger.info(f"Phase transition scheduled: {next_phase} in {delay}s for room {self.id}")
+                    try:
+                        # Check win condition
+                        winner = room.check_game_end()
+                        if winner:
+                            end_game(room, winner)
+                            return
+
+                        # Transition to next phase
+                        if next_phase == 'day':
+                            room.start_day()
+                        elif next_phase == 'night':
+                            room.start_night()
+                    except Exception as e:
+                        logger.error("Error in phase transition: %s", e)
+
+            schedule(delay, do_transition)
+
+            logger.debug("Phase transition scheduled: %s in %ss for room %s", next_phase, delay, self.id)
         except Exception as e:
-            logger.error(f"Error scheduling phase transition: {e}")
+            logger.error("Error scheduling phase transition: %s", e)
 
     def check_game_end(self):
         try:
-            alive_players = [p for p in self.players.values() if p['alive']]
-            alive_mafia = [p for p in alive_players if p['role'] == 'mafia']
-            alive_villagers = [p for p in alive_players if p['role'] != 'mafia']
-            
-            if len(alive_mafia) == 0:
+            if self.alive_mafia == 0:
                 return 'villagers'
-            elif len(alive_mafia) >= len(alive_villagers):
+            elif self.alive_mafia >= self.alive_villagers:
                 return 'mafia'
             return None
         except Exception as e:
-            logger.error(f"Error checking game end: {e}")
+            logger.error("Error checking game end: %s", e)
             return None
 
 # Routes
@@ -269,53 +472,62 @@ def index():
 def health():
     return jsonify({'status': 'healthy', 'rooms': len(rooms), 'players': len(players)})
 
+# Without an X-Sendfile front end, serve images and music straight from the
+# WSGI layer so those requests never reach Flask routing; the routes below
+# then only handle X-Sendfile deployments
+if not app.config['USE_X_SENDFILE']:
+    app.wsgi_app = SharedDataMiddleware(app.wsgi_app, {
+        '/img': os.path.join(app.root_path, 'img'),
+        '/music': os.path.join(app.root_path, 'music')
+    }, cache_timeout=app.config['SEND_FILE_MAX_AGE_DEFAULT'])
+
 @app.route('/img/<path:filename>')
 def serve_image(filename):
-    try:
-        return send_from_directory('img', filename)
-    except:
-        return "Not found", 404
+    return send_from_directory('img', filename)
 
 @app.route('/music/<path:filename>')
 def serve_music(filename):
-    try:
-        return send_from_directory('music', filename)
-    except:
-        return "Not found", 404
+    return send_from_directory('music', filename)
 
 @app.route('/fonts/<path:filename>')
 def serve_fonts(filename):
-    try:
-        return send_from_directory('fonts', filename)
-    except:
-        return "Not found", 404
+    response = send_from_directory('fonts', filename)
+    # Browsers only use cross-origin font responses that carry this header
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
 
 @app.route('/api/rooms', methods=['GET'])
 def get_rooms():
     try:
-        cleanup_empty_rooms()
-        
-        room_list = []
-        for room_id, room in rooms.items():
-            room_list.append({
+        now = time.monotonic()
+        body = _lobby_cache['body']
+        if body is None or now >= _lobby_cache['expires']:
+            generation = _lobby_cache['generation']
+            body = orjson.dumps([{
                 'id': room_id,
                 'name': room.name,
                 'player_count': len(room.players),
                 'max_players': room.max_players,
                 'host_id': room.host_id
-            })
-        
-        return jsonify(room_list)
+            } for room_id, room in rooms.items()])
+            # Only store it if no change invalidated the cache meanwhile
+            with _lobby_lock:
+                if _lobby_cache['generation'] == generation:
+                    _lobby_cache['body'] = body
+                    _lobby_cache['expires'] = now + LOBBY_CACHE_TTL
+        return app.response_class(body, mimetype='application/json')
     except Exception as e:
-        logger.error(f"Error getting rooms: {e}")
+        logger.error("Error getting rooms: %s", e)
         return jsonify([])
 
 @app.route('/api/rooms', methods=['POST'])
 def create_room():
     try:
         data = request.get_json() or {}
-        room_id = str(uuid.uuid4())[:8]
-        host_id = data.get('host_id', str(uuid.uuid4())[:8])
+        room_id = secrets.token_hex(4)
+        while room_id in rooms:
+            room_id = secrets.token_hex(4)
+        host_id = data.get('host_id') or secrets.token_hex(4)
         
         room = GameRoom(
             room_id=room_id,
@@ -325,7 +537,9 @@ def create_room():
         )
         
         rooms[room_id] = room
-        logger.info(f"Room created: {room_id} by {host_id}")
+        invalidate_lobby()
+        queue_room_expiry(room)
+        logger.info("Room created: %s by %s", room_id, host_id)
         
         return jsonify({
             'id': room_id,
@@ -334,7 +548,7 @@ def create_room():
             'host_id': room.host_id
         }), 201
     except Exception as e:
-        logger.error(f"Error creating room: {e}")
+        logger.error("Error creating room: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/rooms/<room_id>')
@@ -349,16 +563,16 @@ def get_room(room_id):
             'name': room.name,
             'max_players': room.max_players,
             'host_id': room.host_id,
-            'players': list(room.players.values())
+            'players': room.public_players()
         })
     except Exception as e:
-        logger.error(f"Error getting room: {e}")
+        logger.error("Error getting room: %s", e)
         return jsonify({'error': 'Server error'}), 500
 
 @app.route('/api/auth/guest', methods=['POST'])
 def guest_login():
     try:
-        guest_id = str(uuid.uuid4())[:8]
+        guest_id = secrets.token_hex(4)
         username = f"Guest_{random.randint(100, 999)}"
         
         user_data = {
@@ -369,41 +583,30 @@ def guest_login():
         
         return jsonify({'user': user_data, 'token': f"guest_{guest_id}"})
     except Exception as e:
-        logger.error(f"Error in guest login: {e}")
+        logger.error("Error in guest login: %s", e)
         return jsonify({'error': 'Login failed'}), 500
 
 # Socket Events
 @socketio.on('connect')
 def handle_connect():
-    logger.info(f"Client connected: {request.sid}")
+    logger.debug("Client connected: %s", request.sid)
     user_sessions[request.sid] = {
         'connected': True,
-        'connected_at': datetime.now()
+        'connected_at': time.time()
     }
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    logger.info(f"Client disconnected: {request.sid}")
+    logger.debug("Client disconnected: %s", request.sid)
     
     try:
-        # Remove player from rooms
-        for room_id, room in list(rooms.items()):
-            if request.sid in room.players:
-                del room.players[request.sid]
-                leave_room(room_id)
-                
-                # Notify others
-                socketio.emit('player_left', {
-                    'player_count': len(room.players)
-                }, room=room_id)
-        
-        # Cleanup
-        cleanup_empty_rooms()
+        # Remove player from their room
+        detach_player(request.sid)
         
         if request.sid in user_sessions:
             del user_sessions[request.sid]
     except Exception as e:
-        logger.error(f"Error during disconnect: {e}")
+        logger.error("Error during disconnect: %s", e)
 
 @socketio.on('join_room')
 def handle_join_room(data):
@@ -416,51 +619,74 @@ def handle_join_room(data):
             return
         
         room = rooms[room_id]
-        
-        if len(room.players) >= room.max_players:
-            emit('error', {'message': 'Room is full'})
-            return
-        
-        # Add player
-        room.players[request.sid] = {
-            'sid': request.sid,
-            'nickname': nickname,
-            'alive': True,
-            'role': None
-        }
-        
-        room.update_activity()
-        join_room(room_id)
-        
-        # Notify all
-        socketio.emit('player_joined', {
-            'player': room.players[request.sid],
-            'players': list(room.players.values())
-        }, room=room_id)
-        
-        logger.info(f"Player {nickname} joined room {room_id}")
+
+        # A socket plays in one room at a time
+        if players.get(request.sid) not in (None, room_id):
+            detach_player(request.sid)
+
+        with room.lock:
+            if rooms.get(room_id) is not room:
+                # Deleted by cleanup while we waited for the lock
+                emit('error', {'message': 'Room not found'})
+                return
+
+            if request.sid in room.players:
+                # Repeated join: keep the existing entry (and its role)
+                emit('room_snapshot', {'players': room.public_players()})
+                return
+
+            if len(room.players) >= room.max_players:
+                emit('error', {'message': 'Room is full'})
+                return
+        
+            # Add player
+            room.players[request.sid] = {
+                'sid': request.sid,
+                'nickname': nickname,
+                'alive': True,
+                'role': None
+            }
+        
+            players[request.sid] = room_id
+            invalidate_lobby()
+            room.update_activity()
+            join_room(room_id)
+        
+            # Full roster for the newcomer, a one-player delta for the room
+            emit('room_snapshot', {'players': room.public_players()})
+            socketio.emit('player_joined', {
+                'player': public_player(room.players[request.sid]),
+                'player_count': len(room.players)
+            }, room=room_id)
+
+        logger.debug("Player %s joined room %s", nickname, room_id)
         
     except Exception as e:
-        logger.error(f"Error joining room: {e}")
+        logger.error("Error joining room: %s", e)
         emit('error', {'message': 'Failed to join room'})
 
+@socketio.on('request_roster')
+def handle_request_roster(data=None):
+    """Resend the full roster to a client whose delta-built copy drifted"""
+    try:
+        room = rooms.get(players.get(request.sid))
+        if not room:
+            return
+
+        with room.lock:
+            emit('room_snapshot', {'players': room.public_players()})
+    except Exception as e:
+        logger.error("Error sending roster: %s", e)
+
 @socketio.on('leave_room')
 def handle_leave_room(data):
     try:
         room_id = data.get('room_id')
-        room = rooms.get(room_id)
         
-        if room and request.sid in room.players:
-            del room.players[request.sid]
-            leave_room(room_id)
-            
-            socketio.emit('player_left', {
-                'player_count': len(room.players)
-            }, room=room_id)
-        
-        cleanup_empty_rooms()
+        if room_id and players.get(request.sid) == room_id:
+            detach_player(request.sid)
     except Exception as e:
-        logger.error(f"Error leaving room: {e}")
+        logger.error("Error leaving room: %s", e)
 
 @socketio.on('start_game')
 def handle_start_game(data):
@@ -472,24 +698,25 @@ def handle_start_game(data):
             emit('error', {'message': 'Only host can start'})
             return
         
-        if len(room.players) < 3:
-            emit('error', {'message': 'Need 3+ players'})
-            return
-        
-        # Assign roles
-        if room.assign_roles():
-            room.start_night()
-            socketio.emit('game_started', {
-                'phase': 'night',
-                'round': 1,
-                'players': list(room.players.values()),
-                'message': 'اللعبة بدأت!'
-            }, room=room_id)
-            logger.info(f"Game started in {room_id}")
-        else:
-            emit('error', {'message': 'Failed to start game'})
+        with room.lock:
+            if len(room.players) < 3:
+                emit('error', {'message': 'Need 3+ players'})
+                return
+        
+            # Assign roles
+            if room.assign_roles():
+                room.start_night()
+                socketio.emit('game_started', {
+                    'phase': 'night',
+                    'round': 1,
+                    'players': room.public_players(),
+                    'message': 'اللعبة بدأت!'
+                }, room=room_id)
+                logger.info("Game started in %s", room_id)
+            else:
+                emit('error', {'message': 'Failed to start game'})
     except Exception as e:
-        logger.error(f"Error starting game: {e}")
+        logger.error("Error starting game: %s", e)
         emit('error', {'message': 'Server error'})
 
 @socketio.on('night_action')
@@ -500,52 +727,90 @@ def handle_night_action(data):
         target_sid = data.get('target_sid')
         
         room = rooms.get(room_id)
-        if not room or room.game_state['phase'] != 'night':
-            return
-        
-        player = room.players.get(request.sid)
-        if not player or not player['alive']:
+        if not room:
             return
-        
-        room.update_activity()
-        
-        if player['role'] == 'mafia' and action == 'kill':
-            room.game_state['mafia_votes'][request.sid] = target_sid
-            emit('action_feedback', {'message': f"🔫 تم اختيار الهدف"})
-        
-        elif player['role'] == 'doctor' and action == 'heal':
-            room.game_state['doctor_votes'][request.sid] = target_sid
-            emit('action_feedback', {'message': f"🏥 تم اختيار من سيتم علاجه"})
-        
-        elif player['role'] == 'detective' and action == 'investigate':
-            room.game_state['detective_votes'][request.sid] = target_sid
-            
-            target_player = room.players.get(target_sid)
-            is_mafia = target_player and target_player.get('role') == 'mafia'
-            
-            emit('investigation_result', {
-                'target': target_player['nickname'] if target_player else 'Unknown',
-                'is_mafia': is_mafia,
-                'message': 'تم التحقيق'
-            })
+
+        with room.lock:
+            if room.game_state['phase'] != 'night':
+                return
+        
+            sid = request.sid
+            roster = room.players
+            game_state = room.game_state
+            player = roster.get(sid)
+            if not player or not player['alive']:
+                return
+
+            # Only alive players in this room are valid targets
+            target_player = roster.get(target_sid)
+            if not target_player or not target_player['alive']:
+                return
+
+            room.update_activity()
+            role = player['role']
+
+            if role == 'mafia' and action == 'kill':
+                if target_player['role'] == 'mafia':
+                    # Mafia may not vote to kill one of their own
+                    return
+                # A repeat only re-sends the reply the client may have missed
+                if game_state['mafia_votes'].get(sid) != target_sid:
+                    game_state['mafia_votes'][sid] = target_sid
+                emit('action_feedback', {'message': f"🔫 تم اختيار الهدف"})
+
+            elif role == 'doctor' and action == 'heal':
+                if game_state['doctor_votes'].get(sid) != target_sid:
+                    game_state['doctor_votes'][sid] = target_sid
+                emit('action_feedback', {'message': f"🏥 تم اختيار من سيتم علاجه"})
+
+            elif role == 'detective' and action == 'investigate':
+                if game_state['detective_votes'].get(sid) != target_sid:
+                    game_state['detective_votes'][sid] = target_sid
+
+                emit('investigation_result', {
+                    'target': target_player['nickname'],
+                    'is_mafia': target_player['role'] == 'mafia',
+                    'message': 'تم التحقيق'
+                })
     except Exception as e:
-        logger.error(f"Error in night action: {e}")
+        logger.error("Error in night action: %s", e)
+
+def detach_player(sid):
+    """Remove sid from the room it is in, if any, and notify the others"""
+    room_id = players.pop(sid, None)
+    room = rooms.get(room_id)
+    if not room:
+        return
+
+    with room.lock:
+        if sid in room.players:
+            room.remove_player(sid)
+            invalidate_lobby()
+            leave_room(room_id, sid=sid)
+
+            socketio.emit('player_left', {
+                'sid': sid,
+                'player_count': len(room.players)
+            }, room=room_id)
+
+            if room.is_empty():
+                queue_room_expiry(room)
 
 def end_game(room, winner):
     try:
         room.game_state['phase'] = 'ended'
         
-        message = "🔫 المافيا فازت!" if winner == 'mafia' else "🎉 القرية فازت!"
+        message = WIN_MESSAGES[winner]
         
         socketio.emit('game_ended', {
             'winner': winner,
             'message': message,
-            'players': list(room.players.values())
+            'players': [revealed_player(p) for p in room.players.values()]
         }, room=room.id)
         
-        logger.info(f"Game ended in {room.id}. Winner: {winner}")
+        logger.info("Game ended in %s. Winner: %s", room.id, winner)
     except Exception as e:
-        logger.error(f"Error ending game: {e}")
+        logger.error("Error ending game: %s", e)
 
 @socketio.on('day_vote')
 def handle_day_vote(data):
@@ -554,28 +819,62 @@ def handle_day_vote(data):
         target_sid = data.get('vote_for_sid')
         
         room = rooms.get(room_id)
-        if not room or room.game_state['phase'] != 'day':
+        if not room:
             return
+
+        with room.lock:
+            if room.game_state['phase'] != 'day':
+                return
         
-        player = room.players.get(request.sid)
-        if not player or not player['alive']:
-            return
+            sid = request.sid
+            roster = room.players
+            player = roster.get(sid)
+            target = roster.get(target_sid)
+            if not player or not player['alive'] or not target or not target['alive']:
+                return
+
+            day_votes = room.game_state['day_votes']
+            if day_votes.get(sid) == target_sid:
+                # Resent vote: nothing changed, so don't re-broadcast it
+                return
         
-        room.update_activity()
-        room.game_state['day_votes'][request.sid] = target_sid
+            room.update_activity()
+            day_votes[sid] = target_sid
         
-        socketio.emit('vote_cast', {
-            'voter': player['nickname'],
-            'voted': room.players[target_sid]['nickname']
-        }, room=room_id)
+            socketio.emit('vote_cast', {
+                'voter': player['nickname'],
+                'voted': target['nickname']
+            }, room=room_id)
     except Exception as e:
-        logger.error(f"Error in day vote: {e}")
+        logger.error("Error in day vote: %s", e)
+
+def parse_chat(data):
+    """Chat text from a client payload, trimmed and capped; '' if unusable"""
+    message = data.get('message')
+    if not isinstance(message, str):
+        return ''
+    message = message.strip()[:MAX_CHAT_LEN]
+    # Control characters never come from the chat input; drop such payloads
+    if any(c < ' ' for c in message):
+        return ''
+    return message
+
+def chat_allowed(sid):
+    """Throttle chat per connection to one message every CHAT_MIN_INTERVAL"""
+    session = user_sessions.get(sid)
+    if session is None:
+        return False
+    now = time.monotonic()
+    if now - session.get('last_chat', 0.0) < CHAT_MIN_INTERVAL:
+        return False
+    session['last_chat'] = now
+    return True
 
 @socketio.on('chat_message')
 def handle_chat_message(data):
     try:
         room_id = data.get('room_id')
-        message = data.get('message', '').strip()
+        message = parse_chat(data)
         
         if not message:
             return
@@ -585,25 +884,25 @@ def handle_chat_message(data):
             return
         
         player = room.players.get(request.sid)
-        if not player:
+        if not player or not chat_allowed(request.sid):
             return
         
         room.update_activity()
         
-        socketio.emit('chat_message', {
+        room.queue_chat('chat_batch', room_id, {
             'from': player['nickname'],
             'text': message,
-            'ts': datetime.now().isoformat(),
+            'ts': int(time.time() * 1000),
             'type': 'public'
-        }, room=room_id)
+        })
     except Exception as e:
-        logger.error(f"Error in chat: {e}")
+        logger.error("Error in chat: %s", e)
 
 @socketio.on('mafia_chat_message')
 def handle_mafia_chat(data):
     try:
         room_id = data.get('room_id')
-        message = data.get('message', '').strip()
+        message = parse_chat(data)
         
         if not message:
             return
@@ -615,44 +914,64 @@ def handle_mafia_chat(data):
         player = room.players.get(request.sid)
         if not player or player['role'] != 'mafia' or not player['alive']:
             return
+        if not chat_allowed(request.sid):
+            return
         
-        # Send to all mafia
-        for sid, p in room.players.items():
-            if p['role'] == 'mafia' and p['alive']:
-                socketio.emit('mafia_chat_message', {
-                    'from': player['nickname'],
-                    'text': message,
-                    'ts': datetime.now().isoformat(),
-                    'type': 'mafia'
-                }, room=sid)
+        # Batched to all alive mafia through their Socket.IO room
+        room.queue_chat('mafia_chat_batch', room.mafia_room, {
+            'from': player['nickname'],
+            'text': message,
+            'ts': int(time.time() * 1000),
+            'type': 'mafia'
+        })
     except Exception as e:
-        logger.error(f"Error in mafia chat: {e}")
+        logger.error("Error in mafia chat: %s", e)
+
+def invalidate_lobby():
+    with _lobby_lock:
+        _lobby_cache['generation'] += 1
+        _lobby_cache['body'] = None
+
+def queue_room_expiry(room):
+    """Queue an empty room for deletion once it has idled for ROOM_IDLE_TTL"""
+    expires_at = room.last_activity + ROOM_IDLE_TTL
+    with _expiry_lock:
+        heapq.heappush(_expiry_heap, (expires_at, room.id))
+    # Wake the cleanup exactly when this entry falls due
+    schedule(max(0, expires_at - time.monotonic()), cleanup_empty_rooms)
 
 def cleanup_empty_rooms():
-    """Remove empty rooms"""
+    """Remove rooms that have been empty for longer than ROOM_IDLE_TTL"""
     try:
-        current_time = datetime.now()
-        rooms_to_delete = []
-        
-        for room_id, room in rooms.items():
-            if room.is_empty():
-                time_empty = (current_time - room.last_activity).total_seconds()
-                if time_empty > 300:
-                    rooms_to_delete.append(room_id)
-                    
-                    # Cancel timer
-                    if room_id in phase_timers:
-                        phase_timers[room_id].cancel()
-                        del phase_timers[room_id]
-        
-        for room_id in rooms_to_delete:
-            close_room(room_id)
-            del rooms[room_id]
-            logger.info(f"Deleted empty room: {room_id}")
+        current_time = time.monotonic()
+        due = []
+
+        with _expiry_lock:
+            while _expiry_heap and _expiry_heap[0][0] <= current_time:
+                due.append(heapq.heappop(_expiry_heap)[1])
+
+        # Re-check under each room's lock (never nested inside _expiry_lock,
+        # which detach_player takes while holding a room lock) so a join
+        # racing with the deletion either lands first or sees the room gone
+        for room_id in due:
+            room = rooms.get(room_id)
+            if not room:
+                continue
+            with room.lock:
+                if (rooms.get(room_id) is not room or not room.is_empty()
+                        or current_time - room.last_activity < ROOM_IDLE_TTL):
+                    continue
+                del rooms[room_id]
+                invalidate_lobby()
+
+                # Cancel pending phase transition
+                phase_timers.pop(room_id, None)
+                socketio.server.close_room(room_id, namespace='/')
+            logger.info("Deleted empty room: %s", room_id)
     except Exception as e:
-        logger.error(f"Cleanup error: {e}")
+        logger.error("Cleanup error: %s", e)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    logger.info(f"Starting server on port {port}")
+    logger.info("Starting server on port %s", port)
     socketio.run(app, host='0.0.0.0', port=port, debug=False)